@@ -1,14 +1,28 @@
 import argparse
-import sys
+import asyncio
 import shutil
 import os
+from urllib.parse import urlsplit
+import json
 import pandas as pd
-from geopy.geocoders import Nominatim
 from unidecode import unidecode
-import json
 
 import utils
 
+# orjson serializes the output much faster, the standard json module (same format) is used when it is not installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# The Rust based calamine reader is much faster than openpyxl, but it is only used when python-calamine is installed
+# (otherwise pandas picks the engine from the file format, input.xlsx is a copy of the legacy .xls source on the first run)
+try:
+    import python_calamine
+    excel_read_engine = 'calamine'
+except ImportError:
+    excel_read_engine = None
+
 # Script parameters
 source_file = './20240401_Lista cabinete medicina de familie_01.04.2024.xls'
 sheet_name = 'Sheet1'
@@ -16,143 +30,170 @@ address_column = 'Adresa punct de lucru'
 json_title_column = 'Nume medic de familie'
 destination_excel_file = 'input.xlsx'
 destination_json_file = 'output.json'
-coordinates_cache_json_file = '.cache/coordinates_cache.json'
-addresses_cache_json_file = '.cache/addresses_cache.json'
-
-# Initialize the cache dictionaries
-coordinates_cache = utils.load_cache(coordinates_cache_json_file)
-addresses_cache = utils.load_cache(addresses_cache_json_file)
+cache_file = '.cache/geocoding_cache.sqlite'
+self_hosted_concurrency = 8 # parallel requests sent to a self-hosted Nominatim instance
+coordinates_cache_json_file = '.cache/coordinates_cache.json' # cache of the previous versions, imported in the SQLite cache
+addresses_cache_json_file = '.cache/addresses_cache.json' # cache of the previous versions, imported in the SQLite cache
 
 # Copy the source folder to the new destination where it will be processed
 source_directory = os.path.dirname(source_file)
 input_file = os.path.join(source_directory, destination_excel_file)
 
-# Read the arguments from the command line
-parser = argparse.ArgumentParser(description='Parse and save with geocoding the list of family medicine offices in Bucharest')
-parser.add_argument('--dev', action='store_true', help='in development mode, only the first 5 addresses are looked up in Nominatim')
-parser.add_argument('--addresses', action='store_true', help='get the clean address if not set in the custom address column')
-parser.add_argument('--geocodes', action='store_true', help='get the latitude and longitude where there are not set in the custom columns')
-parser.add_argument('--excel', action='store_true', help='save the data in the excel format')
-parser.add_argument('--json', action='store_true', help='save the data in json format')
-parser.add_argument('--cache', action='store_true', help='cache addresses and coordinates for use with the new versions of the list of family medicine offices')
-args = parser.parse_args()
-
-if not any(vars(args).values()):
-    parser.print_help()
-    sys.exit(0)
-
-# ensure we have a save function
-if not args.json and not args.excel and not args.cache:
-    print("No save function selected. Cache not being used, either. Exiting...")
-    sys.exit(0)
-
-if not os.path.exists(input_file):
-    shutil.copy(source_file, input_file)
-    print('Input file created')
-
-# Open the excel file
-df = pd.read_excel(input_file, sheet_name)
-
-# Add the new columns (parsed_address in case we need to manually change the address, the latitude and longitude)
-parsed_address = 'parsed_address' # column containing the result of `extract_street_name_and_number`
-manual_address = 'manual_address' # column containing the value of parsed_address by default which can manually be changed (will only be updated manually after being set)
-for column in [parsed_address, manual_address, 'latitude', 'longitude']:
-    if column not in df.columns:
-        df[column] = None
-
-if args.addresses:
-    # Parse the address and get an OSM searchable value (street name and street number)
-    for index, row in df.iterrows():
-        if pd.notna(row[address_column]):
-            street_name_and_number = utils.extract_street_name_and_number(row[address_column])
-            df.at[index, parsed_address] = street_name_and_number
-
-            if pd.isna(row[manual_address]):
-                if args.cache and addresses_cache.get(street_name_and_number) is not None:
-                    df.at[index, manual_address] = addresses_cache[street_name_and_number]
-                else:
-                    df.at[index, manual_address] = street_name_and_number
-        if args.dev and index == 5:
-            break
-
-if args.geocodes:
-    # Use OSM to get the latitude and longitude of each of the addresses
-    geolocator = Nominatim(user_agent='address_validator')
-    for index, row in df.iterrows():
-        address = row[manual_address]
-        if pd.isna(row['latitude']) or pd.isna(row['longitude']):
-            
-            if args.cache and coordinates_cache.get(address) is not None:
-                current_coordinates = coordinates_cache[address]
-                df.at[index, 'latitude'] = current_coordinates['latitude']
-                df.at[index, 'longitude'] = current_coordinates['longitude']
-                print(f"Coordinates retrieved from cache for address at {index}: {address}")
-            else:
-                latitude, longitude = utils.validate_and_get_coordinates(geolocator, address)
-                utils.random_delay(1, 3)
-
-                if latitude is not None and longitude is not None:
-                    df.at[index, 'latitude'] = latitude
-                    df.at[index, 'longitude'] = longitude
-                    print(f"Coordinates retrieved for address at {index}: {address}")
-
-        if args.dev and index == 5:
-            break
-
-if args.excel:
-    # Save the excel file
-    df.to_excel(input_file, sheet_name=sheet_name, index=False, engine='openpyxl')
-    print(f"The data has been saved to {input_file} in Excel format.")
-
-if args.json:
-    # Filter out rows with null latitude and longitude
-    filtered_df = df.dropna(subset=['latitude', 'longitude'])
-
-    # Get the column headers
-    column_headers = df.columns.tolist()
-
-    # Initialize a list to hold JSON entities
-    json_entities = []
-
-    # Create JSON entities
-    for index, row in filtered_df.iterrows():
-        entity = {
-            "title": unidecode(str(row[json_title_column])),
-            "description": [
-                f"{header}: {unidecode(str(row[header])) if isinstance(row[header], str) else row[header]}"
-                for header in column_headers[0:]
-                if header not in [json_title_column, parsed_address, manual_address, 'latitude', 'longitude']
-            ],
-            "latitude": row['latitude'],
-            "longitude": row['longitude']
-        }
-        json_entities.append(entity)
-
-        
-        if args.dev and index == 5:
-            break
-
-    # Save the data as JSON
-    output_file = destination_json_file
-    with open(output_file, 'w') as f:
-        json.dump(json_entities, f, indent=4)
-
-    print(f"The filtered data has been saved to {output_file} in JSON format.")
-
-if args.cache:
-    for index, row in df.iterrows():
-        if pd.notna(row['latitude']) and pd.notna(row['longitude']):
-            address = row[manual_address]
-            coordinates_cache[address] = {
-                'latitude': row['latitude'],
-                'longitude': row['longitude']
+# Run the script (`argv` defaults to the command line arguments, so `main()` can also be called from another module)
+def main(argv=None):
+    # Read the arguments from the command line
+    parser = argparse.ArgumentParser(description='Parse and save with geocoding the list of family medicine offices in Bucharest')
+    parser.add_argument('--dev', action='store_true', help='in development mode, only the first 5 addresses are looked up in Nominatim')
+    parser.add_argument('--addresses', action='store_true', help='get the clean address if not set in the custom address column')
+    parser.add_argument('--geocodes', action='store_true', help='get the latitude and longitude where there are not set in the custom columns')
+    parser.add_argument('--excel', action='store_true', help='save the data in the excel format')
+    parser.add_argument('--json', action='store_true', help='save the data in json format')
+    parser.add_argument('--cache', action='store_true', help='cache addresses and coordinates for use with the new versions of the list of family medicine offices')
+    parser.add_argument('--nominatim-url', help='url of a self-hosted Nominatim instance (e.g. http://localhost:8080), queried in parallel and without the public server rate limit')
+    args = parser.parse_args(argv)
+
+    if not any(vars(args).values()):
+        parser.print_help()
+        return
+
+    # ensure we have a save function
+    if not args.json and not args.excel and not args.cache:
+        print("No save function selected. Cache not being used, either. Exiting...")
+        return
+
+    # Open the cache (indexed lookups and per entry updates, instead of loading and rewriting whole JSON files)
+    if args.cache:
+        cache = utils.open_cache(cache_file, coordinates_cache_json_file, addresses_cache_json_file)
+
+    if not os.path.exists(input_file):
+        shutil.copy(source_file, input_file)
+        print('Input file created')
+
+    # Open the excel file
+    df = pd.read_excel(input_file, sheet_name=sheet_name, engine=excel_read_engine)
+
+    # Add the new columns (parsed_address in case we need to manually change the address, the latitude and longitude)
+    parsed_address = 'parsed_address' # column containing the result of `extract_street_name_and_number`
+    manual_address = 'manual_address' # column containing the value of parsed_address by default which can manually be changed (will only be updated manually after being set)
+    for column in [parsed_address, manual_address, 'latitude', 'longitude']:
+        if column not in df.columns:
+            df[column] = None
+
+    if args.addresses:
+        # Parse the address and get an OSM searchable value (street name and street number)
+        has_address = df[address_column].notna()
+        if args.dev:
+            has_address &= df.index <= 5
+
+        # empty columns are read from the excel file as floats, make sure they can hold the addresses
+        df[[parsed_address, manual_address]] = df[[parsed_address, manual_address]].astype(object)
+        df.loc[has_address, parsed_address] = df.loc[has_address, address_column].map(utils.extract_street_name_and_number)
+
+        # The manual address defaults to the cached one for the parsed address, or to the parsed address itself
+        missing_manual_address = has_address & df[manual_address].isna()
+        default_manual_address = df.loc[missing_manual_address, parsed_address]
+        if args.cache:
+            cached_addresses = utils.get_cached_addresses(cache, default_manual_address.dropna().unique())
+            default_manual_address = default_manual_address.map(cached_addresses).fillna(default_manual_address)
+        df.loc[missing_manual_address, manual_address] = default_manual_address
+
+    if args.geocodes:
+        # Use OSM to get the latitude and longitude of each of the addresses
+        missing_mask = df['latitude'].isna() | df['longitude'].isna()
+        if args.dev:
+            missing_mask &= df.index <= 5
+
+        if args.cache:
+            # Apply the cached coordinates to all the rows without coordinates in a single pass
+            cached_coordinates = utils.get_cached_coordinates(cache, df.loc[missing_mask, manual_address].dropna().unique())
+            from_cache = utils.apply_coordinates(df, missing_mask, manual_address, cached_coordinates)
+            missing_mask &= ~from_cache
+            print(f"Coordinates retrieved from cache for {from_cache.sum()} row(s)")
+
+        # Look up each distinct address once, even when it is shared by many rows
+        unique_addresses = df.loc[missing_mask, manual_address].dropna().unique().tolist()
+
+        # Look up all the addresses in one asyncio session, then apply the results the same way as the cached ones
+        if args.nominatim_url:
+            # the usage policy of the public server does not apply to a self-hosted instance
+            nominatim_url = urlsplit(args.nominatim_url if '://' in args.nominatim_url else f'http://{args.nominatim_url}')
+            geocoded = asyncio.run(utils.geocode_batch(unique_addresses, user_agent='address_validator', min_delay_seconds=0,
+                                                       domain=nominatim_url.netloc + nominatim_url.path.rstrip('/'), scheme=nominatim_url.scheme,
+                                                       concurrency=self_hosted_concurrency))
+        else:
+            geocoded = asyncio.run(utils.geocode_batch(unique_addresses, user_agent='address_validator'))
+        from_nominatim = utils.apply_coordinates(df, missing_mask, manual_address, geocoded)
+        print(f"Coordinates retrieved for {from_nominatim.sum()} row(s) with {len(geocoded)} address(es)")
+
+        if args.cache:
+            # Store the new coordinates right away, so that they are kept even if a later step fails
+            utils.set_cached_coordinates(cache, geocoded)
+
+    if args.excel:
+        # Save the excel file
+        # xlsxwriter streams the rows to the file instead of building an openpyxl workbook model in memory
+        # (the cell values are written as they are, without turning them into formulas or links)
+        df.to_excel(input_file, sheet_name=sheet_name, index=False, engine='xlsxwriter',
+                    engine_kwargs={'options': {'strings_to_formulas': False, 'strings_to_urls': False}})
+        print(f"The data has been saved to {input_file} in Excel format.")
+
+    if args.json:
+        # Filter out rows with null latitude and longitude
+        filtered_df = df.dropna(subset=['latitude', 'longitude'])
+        if args.dev:
+            filtered_df = filtered_df.loc[:5]
+
+        # Get the column headers shown in the description (computed once, not per row)
+        excluded_headers = {json_title_column, parsed_address, manual_address, 'latitude', 'longitude'}
+        description_headers = [header for header in df.columns if header not in excluded_headers]
+
+        # Transliterate the distinct values of the text columns once, the repeated values (e.g. the provider) reuse the result
+        ascii_df = filtered_df[[json_title_column, *description_headers]].copy()
+        for column in ascii_df.select_dtypes('object'):
+            distinct_values = ascii_df[column].dropna().unique()
+            ascii_df[column] = ascii_df[column].map({value: unidecode(value) if isinstance(value, str) else value for value in distinct_values})
+
+        # Build every description line of a column with one vectorized concat, then zip the columns into the entities
+        titles = ascii_df[json_title_column].astype(str)
+        description_columns = [(f"{header}: " + ascii_df[header].astype(str)).to_numpy() for header in description_headers]
+
+        json_entities = [
+            {
+                "title": title,
+                "description": list(description),
+                "latitude": latitude,
+                "longitude": longitude
             }
-        if pd.notna(row[parsed_address]) and pd.notna(row[manual_address]):
-            addresses_cache[row[parsed_address]] = row[manual_address]
+            for title, description, latitude, longitude in zip(
+                titles,
+                zip(*description_columns),
+                filtered_df['latitude'].tolist(),
+                filtered_df['longitude'].tolist()
+            )
+        ]
+
+        # Save the data as JSON
+        output_file = destination_json_file
+        with open(output_file, 'wb') as f:
+            if orjson:
+                f.write(orjson.dumps(json_entities, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY))
+            else:
+                f.write(json.dumps(json_entities, indent=2, ensure_ascii=False).encode())
+
+        print(f"The filtered data has been saved to {output_file} in JSON format.")
+
+    if args.cache:
+        cache_df = df.loc[:5] if args.dev else df
+
+        # Build the cache entries with vectorized filters instead of a row by row pass (the last row wins for duplicates)
+        coordinates_df = cache_df.dropna(subset=[manual_address, 'latitude', 'longitude']).drop_duplicates(manual_address, keep='last')
+        utils.set_cached_coordinates(cache, coordinates_df.set_index(manual_address)[['latitude', 'longitude']].to_dict('index'))
+
+        addresses_df = cache_df.dropna(subset=[parsed_address, manual_address]).drop_duplicates(parsed_address, keep='last')
+        utils.set_cached_addresses(cache, addresses_df.set_index(parsed_address)[manual_address].to_dict())
 
-        if args.dev and index == 5:
-            break
-    utils.save_cache(coordinates_cache_json_file, coordinates_cache)
-    utils.save_cache(addresses_cache_json_file, addresses_cache)
+        cache.close()
+        print(f"The cache has been saved to {cache_file} ({len(coordinates_df)} coordinates, {len(addresses_df)} addresses).")
 
-    print(f"The cache has been saved in JSON format.")
\ No newline at end of file
+if __name__ == '__main__':
+    main()
\ No newline at end of file
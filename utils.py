@@ -1,91 +1,235 @@
 from unidecode import unidecode
 import re
+from functools import lru_cache
 
-from random import randint
-from time import sleep
+import asyncio
 
 import json
+import numpy as np
 import os
+import sqlite3
 
-# A file based cache to store the coordinates
+# orjson parses the JSON caches much faster, the standard json module is used when it is not installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# A file based cache to store the coordinates (the JSON format used by the previous versions)
 def load_cache(cache_file):
     if os.path.exists(cache_file):
-        with open(cache_file, 'r') as file:
-            return json.load(file)
+        with open(cache_file, 'rb') as file:
+            return orjson.loads(file.read()) if orjson else json.load(file)
     else:
         return {}
 
-def save_cache(cache_file, cache):
-    print(f"Saving cache to {cache_file} {len(cache)} entries...")
+# A SQLite based cache for the addresses and the coordinates, the JSON caches of the previous versions are imported when it is created
+def open_cache(cache_file, coordinates_json_file, addresses_json_file):
+    is_new = not os.path.exists(cache_file)
+
+    connection = sqlite3.connect(cache_file)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    connection.execute('CREATE TABLE IF NOT EXISTS coordinates (address TEXT PRIMARY KEY, latitude REAL, longitude REAL)')
+    connection.execute('CREATE TABLE IF NOT EXISTS addresses (parsed_address TEXT PRIMARY KEY, manual_address TEXT)')
+
+    if is_new:
+        set_cached_coordinates(connection, load_cache(coordinates_json_file))
+        set_cached_addresses(connection, load_cache(addresses_json_file))
+
+    return connection
+
+# Get the cached coordinates of the given addresses as {address: {'latitude': float, 'longitude': float}}
+def get_cached_coordinates(connection, addresses):
+    rows = connection.execute(
+        'SELECT address, latitude, longitude FROM coordinates WHERE address IN (SELECT value FROM json_each(?))',
+        (json.dumps(list(addresses)),)
+    )
+    return {address: {'latitude': latitude, 'longitude': longitude} for address, latitude, longitude in rows}
+
+def set_cached_coordinates(connection, coordinates):
+    with connection:
+        connection.executemany(
+            'INSERT OR REPLACE INTO coordinates (address, latitude, longitude) VALUES (?, ?, ?)',
+            [(address, value['latitude'], value['longitude']) for address, value in coordinates.items()]
+        )
 
-    with open(cache_file, 'w') as file:
-        json.dump(cache, file)
+# Get the cached manual addresses of the given parsed addresses as {parsed_address: manual_address}
+def get_cached_addresses(connection, parsed_addresses):
+    rows = connection.execute(
+        'SELECT parsed_address, manual_address FROM addresses WHERE parsed_address IN (SELECT value FROM json_each(?))',
+        (json.dumps(list(parsed_addresses)),)
+    )
+    return dict(rows)
 
-# Extract street and number from addresses
+def set_cached_addresses(connection, addresses):
+    with connection:
+        connection.executemany(
+            'INSERT OR REPLACE INTO addresses (parsed_address, manual_address) VALUES (?, ?)',
+            list(addresses.items())
+        )
+
+# Address cleanup patterns, fused in a single alternation so the address is scanned once
+# (each named group is the canonical prefix of the street or number, ensure there is a space at the end of the replacement)
+# the patterns are lowercase and matched against the lowercased address, instead of being case insensitive
+# the lookahead on the first letters of the aliases skips the other positions without trying every alternative
+cleanupRegex = re.compile('(?=[abcdinps])(?:' + '|'.join([
+    # fix for number not separated, also covers the text cleanup of the number prefix
+    r"(?P<nr>nr)",
+    r"(?P<Numarul>(?:numarul\.|numarul)\s)",
+
+    r"(?P<Calea>(?:calea|cal)\s|(?:cal\.))",
+    r"(?P<Piata>(?:piata|pta)\s|(?:pta\.))",
+    r"(?P<Drumul>(?:drumul)\s)",
+    r"(?P<Strada>(?:strada|str)\s|(?:str\.|stra\.))",
+    r"(?P<Bulevardul>(?:bulevardul|bulevard|bd|bld|b-dul)\s|(?:bd\.|bld\.))",
+    r"(?P<Soseaua>(?:soseaua|sos)\s|(?:sos\.))",
+    r"(?P<Splaiul>(?:splaiul|spl)\s|(?:spl\.))",
+    r"(?P<Aleea>(?:aleea)\s|(?:al\.))",
+    r"(?P<Intrarea>(?:intarea|int|intr)\s|(?:int\.|intr\.))",
+]) + ')')
+cleanupReplacements = {'nr': ', Numarul ', 'Numarul': 'Numarul ', 'Calea': 'Calea ', 'Piata': 'Piata ', 'Drumul': 'Drumul ', 'Strada': 'Strada ', 'Bulevardul': 'Bulevardul ',
+                       'Soseaua': 'Soseaua ', 'Splaiul': 'Splaiul ', 'Aleea': 'Aleea ', 'Intrarea': 'Intrarea '}
+# Romanian diacritics (comma and cedilla forms), transliterated without going through unidecode
+romanianTranslation = str.maketrans('șțăâîȘȚĂÂÎşţŞŢ', 'staaiSTAAIstST')
+# Canonical street prefixes and number prefix, found with plain string methods once the address is cleaned up
+streetPrefixes = ('Calea', 'Piata', 'Drumul', 'Strada', 'Bulevardul', 'Soseaua', 'Splaiul', 'Aleea', 'Intrarea')
+numberPrefix = 'Numarul '
+
+# Extract street and number from addresses (memoized, the same address is repeated for the offices sharing a location)
+@lru_cache(maxsize=4096)
 def extract_street_name_and_number(address):
-    # use alphanumeric characters
-    address = unidecode(address)
-
-    # ensure we have the proper prefix for the street
-    cleanupRegexList = [
-        # fix for number not separated 
-        ["nr", ", nr"],
-
-        # text cleanup (ensure there is a space at the end of the replace string)
-        [r"((?:Numarul\.|Numarul|Nr\.|Nr)\s|(?:Nr\.))", 'Numarul '],
-
-        [r"((?:Calea|Cal)\s|(?:Cal\.))", 'Calea'],
-        [r"((?:Calea|Cal)\s|(?:Cal\.))", 'Calea '],
-        [r"((?:Piata|Pta)\s|(?:Pta\.))", 'Piata '],
-        [r"((?:Drumul)\s)", 'Drumul '],
-        [r"((?:Strada|Str)\s|(?:Str\.|Stra\.))", 'Strada '],
-        [r"((?:Bulevardul|Bulevard|Bd|Bld|B-dul)\s|(?:Bd\.|Bld\.))", 'Bulevardul '],
-        [r"((?:Soseaua|Sos)\s|(?:Sos\.))", 'Soseaua '],
-        [r"((?:Splaiul|Spl)\s|(?:Spl\.))", 'Splaiul '],
-        [r"((?:Aleea)\s|(?:Al\.))", 'Aleea '],
-        [r"((?:Intarea|Int|Intr)\s|(?:Int\.|Intr\.))", 'Intrarea ']
-    ]
-
-    for regex in cleanupRegexList:
-        address = re.sub(regex[0], f'{regex[1]} ', address, flags=re.I)
-
-    # commas and spaces
+    # use alphanumeric characters (unidecode is only needed for characters outside the Romanian alphabet)
+    if not address.isascii():
+        address = address.translate(romanianTranslation)
+        if not address.isascii():
+            address = unidecode(address)
+
+    # the address is ASCII at this point, so the lowercased copy has the same positions as the original
+    parts = []
+    end = 0
+    for match in cleanupRegex.finditer(address.lower()):
+        parts += [address[end:match.start()], cleanupReplacements[match.lastgroup]]
+        end = match.end()
+    parts.append(address[end:])
+    address = ''.join(parts)
+
+    # commas and spaces (plain string replacements, no need for the regex engine)
     while ",," in address:
-        address = re.sub(r",,", ",", address)
+        address = address.replace(",,", ",")
     while "  " in address:
-        address = re.sub(r"  ", " ", address)
-    address = re.sub(r" ,", ",", address)
-    address = re.sub(r", ", ",", address)
+        address = address.replace("  ", " ")
+    address = address.replace(" ,", ",").replace(", ", ",")
     
-    # get the street and number
-    returnAddress = ''
+    # get the street and number (each one ends at the next comma, and must be on a single line)
+    # the street part is left empty when it is not found, so the number stays the second part of the address
+    returnParts = ['']
 
-    streetMatch = re.match(r"(Calea|Piata|Drumul|Strada|Bulevardul|Soseaua|Splaiul|Aleea|Intrarea)(.*?)(?:,)", address)
-    if (streetMatch):
-        returnAddress = ''.join(streetMatch.group(1, 2))
+    if address.startswith(streetPrefixes):
+        streetEnd = address.find(',')
+        if streetEnd != -1 and '\n' not in address[:streetEnd]:
+            returnParts[0] = address[:streetEnd]
 
-    numberMatch = re.search(r"(Numarul )(.*?)(?:,)", address)
-    if (numberMatch):
-        returnAddress = f"{returnAddress}, {numberMatch.group(2)}"
+    numberStart = address.find(numberPrefix)
+    while numberStart != -1:
+        numberEnd = address.find(',', numberStart + len(numberPrefix))
+        if numberEnd == -1:
+            break
+        if '\n' not in address[numberStart:numberEnd]:
+            returnParts.append(address[numberStart + len(numberPrefix):numberEnd])
+            break
+        numberStart = address.find(numberPrefix, numberStart + 1)
 
     # return the parsed address
     # TODO: we could add the sector to the address
-    return f"{returnAddress}, Bucuresti"
+    returnParts.append('Bucuresti')
+    return ', '.join(returnParts)
+
+# Turn an address in the "<street>, <number>, Bucuresti" format (the output of `extract_street_name_and_number`) into a Nominatim structured query
+def get_structured_query(address):
+    parts = [part.strip() for part in address.split(',')]
+    if len(parts) not in (2, 3) or parts[-1].lower() != 'bucuresti' or not all(parts):
+        return None
+
+    # Nominatim expects the house number before the street name
+    street = ' '.join(reversed(parts[:-1]))
+    return {'street': street, 'city': parts[-1], 'country': 'Romania'}
+
+# Get coordinates using OSM (`geocode` is the rate limited, asynchronous geocode function of the geolocator)
+# returns (None, None) when the address is not found and None when the lookup failed (e.g. the server is unavailable)
+async def validate_and_get_coordinates(geocode, address, structured=True):
+    # the structured query is matched faster by Nominatim, the free text one is kept as a fallback (also when the structured one fails)
+    structured_query = get_structured_query(address) if structured else None
+    location = None
+    structured_error = None
+    if structured_query:
+        try:
+            location = await geocode(structured_query)
+        except Exception as e:
+            structured_error = e
+            print(f"Structured query failed for address '{address}', trying the free text one: {e}")
 
-# Get coordinates using OSM
-def validate_and_get_coordinates(geolocator, address):
     try:
-        location = geolocator.geocode(address)
+        if location is None:
+            location = await geocode(address)
+
         if location:
             return location.latitude, location.longitude
+        elif structured_error:
+            # not a clean miss, the structured query could have found the address
+            print(f"Error occurred while validating address '{address}': {structured_error}")
+            return None
         else:
             # TODO: in case we don't have a match, we could try to remove the street type
             print(f"Location not available for '{address}'")
             return None, None
     except Exception as e:
         print(f"Error occurred while validating address '{address}': {e}")
-        return None, None
-    
-# Sleep for a random number of seconds, mainly to avoid hitting api limits
-def random_delay(min, max):
-    sleep(randint(min, max))
\ No newline at end of file
+        return None
+
+# Coordinates already looked up by this process, one memo per server and query type
+# ({(domain, scheme, structured): {address: (latitude, longitude)}}, addresses not found included, failed lookups excluded)
+_geocoded_coordinates = {}
+
+# Get coordinates using OSM for many addresses in a single asyncio session
+# (`domain` and `scheme` point to a self-hosted Nominatim instance, which can be queried with a higher `concurrency`)
+async def geocode_batch(addresses, user_agent, min_delay_seconds=1.0, structured=True, domain=None, scheme=None, concurrency=1):
+    # only the addresses which were not looked up before (on the same server, with the same query type) are sent to Nominatim
+    geocoded_coordinates = _geocoded_coordinates.setdefault((domain, scheme, structured), {})
+    new_addresses = [address for address in dict.fromkeys(addresses) if address not in geocoded_coordinates]
+    if new_addresses:
+        # geopy (and aiohttp) are only loaded when there is something to look up
+        from geopy.adapters import AioHTTPAdapter
+        from geopy.extra.rate_limiter import AsyncRateLimiter
+        from geopy.geocoders import Nominatim
+
+        server = {key: value for key, value in {'domain': domain, 'scheme': scheme}.items() if value}
+        async with Nominatim(user_agent=user_agent, adapter_factory=AioHTTPAdapter, **server) as geolocator:
+            # by default, at most one request per second and one request in flight, as required by the Nominatim usage policy
+            geocode = AsyncRateLimiter(geolocator.geocode, min_delay_seconds=min_delay_seconds, max_retries=2, swallow_exceptions=False)
+            semaphore = asyncio.Semaphore(concurrency)
+
+            async def limited(address):
+                async with semaphore:
+                    return await validate_and_get_coordinates(geocode, address, structured)
+
+            coordinates = await asyncio.gather(*[limited(address) for address in new_addresses])
+        # the failed lookups are not remembered, so that they are retried by the next call
+        geocoded_coordinates.update((address, result) for address, result in zip(new_addresses, coordinates) if result is not None)
+
+    found = {}
+    for address in addresses:
+        latitude, longitude = geocoded_coordinates.get(address, (None, None))
+        if latitude is not None and longitude is not None:
+            found[address] = {'latitude': latitude, 'longitude': longitude}
+    return found
+
+# Set the coordinates of the masked rows whose address is found in `coordinates`, returns the mask of the updated rows
+def apply_coordinates(df, mask, address_column, coordinates):
+    addresses = df[address_column].where(mask)
+    latitudes = addresses.map({address: value['latitude'] for address, value in coordinates.items()})
+    longitudes = addresses.map({address: value['longitude'] for address, value in coordinates.items()})
+    updated = latitudes.notna() & longitudes.notna()
+
+    df.loc[updated, ['latitude', 'longitude']] = np.column_stack([latitudes[updated], longitudes[updated]])
+    return updated
\ No newline at end of file